@@ -1,3 +1,4 @@
+import functools
 import logging
 import os
 import numpy as np
@@ -7,8 +8,7 @@ import datetime
 from dateutil.relativedelta import relativedelta
 
 # JSON export
-import json
-import geojson
+import orjson
 from covjson_pydantic.reference_system import ReferenceSystem
 from covjson_pydantic.domain import Domain
 from covjson_pydantic.ndarray import NdArray
@@ -198,12 +198,14 @@ class DroughtIndex(ABC):
         # Need both to support different output formats
         self.data_df = pd.DataFrame()
         self.data_ds = xr.Dataset()
+        # Set once process() has run
+        self.processed = False
 
     @property
     def index_shortname(self):
         return type(self).__name__.replace('_', '')
 
-    @property
+    @functools.cached_property
     def output_file_path(self):
         """
         Returns the path to the output file from processing
@@ -232,6 +234,8 @@ class DroughtIndex(ABC):
             file_ext = 'csv'
         elif "net" in oformat:  # Generate NetCDF
             file_ext = 'nc'
+        elif "zarr" in oformat:  # Generate Zarr store
+            file_ext = 'zarr'
         else:  # Generate GeoJSON
             file_ext = 'json'
 
@@ -259,9 +263,6 @@ class DroughtIndex(ABC):
          Generates GeoJSON file for data
          :return: path to the geojson file
          """
-        # Build GeoJSON object
-        self.feature_collection = {"type": "FeatureCollection", "features": []}
-
         # Reindex and drop duplicates
         df = self.data_df.set_index(['time', 'latitude', 'longitude'])
         df = df.drop_duplicates()
@@ -270,33 +271,15 @@ class DroughtIndex(ABC):
         # Drop if whole row is NANs
         df = df.dropna(how='all')
 
-        # Replace NANs with None
-        df = df.replace(to_replace=np.NAN, value=None)
-
-        for i in df.index:
-            feature = {"type": "Feature", "geometry": {"type": "Point", "coordinates": [float(i[2]), float(i[1])]},
-                       "properties": {}}
-
-            # Extract columns as properties
-            property = df.loc[i].to_json(date_format='iso', force_ascii=True)
-            parsed = json.loads(property)
-
-            # Add time as a property
-            properties = {}
-            # dateval = pd.to_datetime(str(datevals[count])).strftime("%Y-%m-%d")
-            properties.update({"_date": i[0].strftime("%Y-%m-%d")})
-            properties.update(parsed)
-            feature['properties'] = properties
-            # Add feature
-            self.feature_collection['features'].append(feature)
-        dump = geojson.dumps(self.feature_collection, indent=4)
-        # self.logger.info("JSON: ",dump)
-
-        # Reload to check formatting
-        json_x = geojson.loads(dump)
+        # Build every feature in one pass, with the time added as a property; NaNs are written as null
+        features = [{"type": "Feature", "geometry": {"type": "Point", "coordinates": [float(i[2]), float(i[1])]},
+                     "properties": {"_date": i[0].strftime("%Y-%m-%d"), **props}}
+                    for i, props in zip(df.index, df.to_dict('records'))]
+        self.feature_collection = {"type": "FeatureCollection", "features": features}
 
-        with open(self.output_file_path, "w", encoding='utf-8') as outfile:
-            geojson.dump(json_x, outfile, indent=4)
+        with open(self.output_file_path, "wb") as outfile:
+            outfile.write(orjson.dumps(self.feature_collection, default=pd.Timestamp.isoformat,
+                                       option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
 
     def generate_covjson(self) -> None:
         """
@@ -454,7 +437,8 @@ class DroughtIndex(ABC):
     def generate_output(self) -> None:
         # Save to chosen output format
         self.logger.info('Generating output...')
-        if not os.path.isfile(self.output_file_path):
+        # Zarr stores are folders, so check for any existing path
+        if not os.path.exists(self.output_file_path):
 
             oformat = self.args.oformat.lower()
             if "cov" in oformat:  # Generate CoverageJSON file
@@ -471,8 +455,17 @@ class DroughtIndex(ABC):
             elif "net" in oformat:  # Generate NetCDF
 
                 # drop if whole time-series is NANs
-                df = self.data_ds.dropna(dim='time', how='all')
-                xr.Dataset(df).to_netcdf(self.output_file_path)
+                df = xr.Dataset(self.data_ds.dropna(dim='time', how='all'))
+                # Single precision is ample for precipitation and the indices, and compresses far better
+                encoding = {var: {'dtype': 'float32', 'zlib': True, 'complevel': 5}
+                            for var in df.data_vars if df[var].dtype == np.float64}
+                df.to_netcdf(self.output_file_path, encoding=encoding)
+
+            elif "zarr" in oformat:  # Generate Zarr store
+
+                # drop if whole time-series is NANs
+                ds = xr.Dataset(self.data_ds.dropna(dim='time', how='all'))
+                ds.to_zarr(self.output_file_path, mode='w', consolidated=True)
 
             else:  # Generate GeoJSON
                 self.generate_geojson()
@@ -534,7 +527,8 @@ class GDODroughtIndex(DroughtIndex):
     def load_and_trim(self):
 
         def open_point(fname):
-            return xr.open_dataset(fname).sel(lat=self.args.latitude, lon=self.args.longitude,
+            # Point time series read much faster from a copy chunked along time, written on the first point read
+            return xr.open_dataset(gdo.write_timeseries_copy(fname)).sel(lat=self.args.latitude, lon=self.args.longitude,
                                               method='nearest').drop_vars(['4326'])
 
         def open_bbox(fname):
@@ -613,6 +607,7 @@ class SPI_GDO(GDODroughtIndex):
         # Drop locations outside of selected area
         df = df[df.spg03 != OUTSIDE_AREA_SELECTION]
         self.data_df = df
+        self.processed = True
 
         return df
 
@@ -717,8 +712,7 @@ class SPI_ECMWF(DroughtIndex):
             # print("ECMWF ds: ",ds)
 
         else:
-            spi_vals = xr.apply_ufunc(spi.calc_spi, da, input_core_dims=[['time']], output_core_dims=[['time']],
-                                      vectorize=True)
+            spi_vals = spi.calc_spi_grid(da)
 
             # Store spi
             ds = xr.Dataset(data_vars={'tp': da, 'spi': spi_vals})
@@ -757,6 +751,7 @@ class SPI_ECMWF(DroughtIndex):
         # store processed data on object
         self.data_ds = ds_reindexed
         self.data_df = df_reindexed
+        self.processed = True
 
         self.generate_output()
 
@@ -852,10 +847,11 @@ class SPI_NCG(DroughtIndex):
 
         # Fill any missing gaps
         time_months = pd.date_range(self.args.start_date, self.args.end_date, freq='1MS')
-        df_filtered = utils.fill_gaps(time_months, df_filtered)
+        df_filtered = utils.fill_gaps_df(time_months, df_filtered)
 
         # store processed data on object
         self.data_df = df_filtered
+        self.processed = True
 
         self.generate_output()
 
@@ -972,12 +968,13 @@ class FEATURE_SAFE(DroughtIndex):
         ds = ds.sel(time=slice(pd.Timestamp(self.config.baseline_start), pd.Timestamp(clip_date)))
 
         # Load SAFE data
-        safe = load.LoadSAFE(logger=logging, infile=self.filename)
+        safe = load.LoadSAFE(logger=logging, infile=self.filename, cache_dir=self.config.outdir)
         df_filtered = safe.load_safe(ds.to_dataframe().reset_index(), lat_val=self.args.latitude[0],
                                      lon_val=self.args.longitude[0])
 
         # Generate output file
         self.data_df = df_filtered
+        self.processed = True
         self.generate_output()
 
         self.logger.info("Completed processing of SAFE FEATURE data.")
@@ -1040,8 +1037,7 @@ class FEATURE_SAFE(DroughtIndex):
             # print("ds: ",ds)
 
         else:
-            spi_vals = xr.apply_ufunc(spi.calc_spi, da, input_core_dims=[['time']], output_core_dims=[['time']],
-                                      vectorize=True)
+            spi_vals = spi.calc_spi_grid(da)
 
             # Store spi
             ds = xr.Dataset(data_vars={'tp': da, 'spi': spi_vals})
@@ -1141,10 +1137,11 @@ class SPI_NCG(DroughtIndex):
 
         # Fill any missing gaps
         time_months = pd.date_range(self.args.start_date,self.args.end_date,freq='1MS')
-        df_filtered = utils.fill_gaps(time_months,df_filtered)
+        df_filtered = utils.fill_gaps_df(time_months,df_filtered)
 
         # store processed data on object
         self.data_df = df_filtered
+        self.processed = True
 
         self.generate_output()
 
@@ -1256,11 +1253,12 @@ class FEATURE_SAFE(DroughtIndex):
         ds = ds.sel(time=slice(pd.Timestamp(self.config.baseline_start), pd.Timestamp(clip_date)))
 
         # Load SAFE data
-        safe = load.LoadSAFE(logger=logging,infile=self.filename)
+        safe = load.LoadSAFE(logger=logging,infile=self.filename,cache_dir=self.config.outdir)
         df_filtered = safe.load_safe(ds.to_dataframe().reset_index(), lat_val=self.args.latitude[0], lon_val=self.args.longitude[0])
 
         # Generate output file
         self.data_df = df_filtered
+        self.processed = True
         self.generate_output()
 
         self.logger.info("Completed processing of SAFE FEATURE data.")
@@ -1323,8 +1321,7 @@ class FEATURE_SAFE(DroughtIndex):
             # print("ds: ",ds)
 
         else:
-            spi_vals = xr.apply_ufunc(spi.calc_spi, da, input_core_dims=[['time']], output_core_dims=[['time']],
-                                      vectorize=True)
+            spi_vals = spi.calc_spi_grid(da)
 
             # Store spi
             ds = xr.Dataset(data_vars={'tp': da, 'spi': spi_vals})
@@ -1465,6 +1462,7 @@ class SMA_ECMWF(DroughtIndex):
 
         self.data_ds = swv_dekads
         self.data_df = swv_dekads.to_dataframe().reset_index()
+        self.processed = True
         # Output to JSON
         self.generate_output()
 
@@ -1522,6 +1520,7 @@ class SMA_GDO(GDODroughtIndex):
         self.logger.info('Reducing to requested area...')
         df = df[df.smant != OUTSIDE_AREA_SELECTION]
         self.data_df = df
+        self.processed = True
         return df
 
 
@@ -1551,6 +1550,7 @@ class FPAR_GDO(GDODroughtIndex):
         # Drop locations outside of selected area
         df = df[df.fpanv != OUTSIDE_AREA_SELECTION]
         self.data_df = df
+        self.processed = True
 
         return df
 
@@ -1565,8 +1565,15 @@ class CDI(DroughtIndex):
     def __init__(
             self,
             cfg: config.Config,
-            args: config.CDIArgs
+            args: config.CDIArgs,
+            fpr: 'FPAR_GDO' = None
     ):
+        """
+        Initializer
+        :param cfg: config object
+        :param args: CDI analysis args object
+        :param fpr: optional fAPAR index to use, built with fpr_args(args); it does not depend on the SPI/SMA source so may be shared between CDIs
+        """
 
         # Get variable details for requested products
         vars = dict(filter(lambda k: k[0] in [args.spi_var, args.sma_var, args.fpr_var, 'CDI'], ALL_VARS.items()))
@@ -1575,15 +1582,10 @@ class CDI(DroughtIndex):
 
         # Initialise all separate indicators to be combined
         sdate_ts = pd.Timestamp(args.start_date)
-        sdate_dk = sdate_ts.replace(day=utils.nearest_dekad(sdate_ts.day))
+        sdate_dk = self.dekad_start(args)
 
         def aa_new(required_sdate: pd.Timestamp) -> config.AnalysisArgs:
-            """
-            Helper function to quickly return modified arguments
-            """
-            # Makes sure start date is in dekads and the required format
-            sdate = required_sdate.replace(day=utils.nearest_dekad(required_sdate.day))
-            return config.AnalysisArgs(args.latitude, args.longitude, sdate.strftime('%Y%m%d'), args.end_date)
+            return self.component_args(args, required_sdate)
 
         # SPI dates are always at the start of each month because it's the monthly average
         sdate_spi = sdate_ts.replace(day=1) - relativedelta(months=1)
@@ -1598,18 +1600,42 @@ class CDI(DroughtIndex):
         self.sma = sma_class(cfg, self.aa_sma)
 
         # fAPAR - 1 dekad before
-        sdate_fpr = sdate_dk - relativedelta(days=10)
-        self.aa_fpr = aa_new(sdate_fpr)
-        self.fpr = FPAR_GDO(cfg, self.aa_fpr)
+        self.aa_fpr = self.fpr_args(args)
+        self.fpr = fpr if fpr is not None else FPAR_GDO(cfg, self.aa_fpr)
 
         # Initialise times
         # We want our final timeseries to include all data from the beginning of the SPI to the end of the CDI, so all data can be retained
         self.time_dekads = utils.dti_dekads(sdate_spi, args.end_date)
 
+    @staticmethod
+    def dekad_start(args: config.AnalysisArgs) -> pd.Timestamp:
+        """
+        Start of the dekad containing the CDI start date
+        """
+        sdate_ts = pd.Timestamp(args.start_date)
+        return sdate_ts.replace(day=utils.nearest_dekad(sdate_ts.day))
+
+    @staticmethod
+    def component_args(args: config.AnalysisArgs, required_sdate: pd.Timestamp) -> config.AnalysisArgs:
+        """
+        Helper function to quickly return modified arguments
+        """
+        # Makes sure start date is in dekads and the required format
+        sdate = required_sdate.replace(day=utils.nearest_dekad(required_sdate.day))
+        return config.AnalysisArgs(args.latitude, args.longitude, sdate.strftime('%Y%m%d'), args.end_date)
+
+    @staticmethod
+    def fpr_args(args: config.AnalysisArgs) -> config.AnalysisArgs:
+        """
+        Arguments of the fAPAR index combined into a CDI, which starts one dekad before it
+        """
+        return CDI.component_args(args, CDI.dekad_start(args) - relativedelta(days=10))
+
     def download(self):
         spi_file = self.spi.download()
         sma_file = self.sma.download()
-        fpr_file = self.fpr.download()
+        # fAPAR does not depend on the SPI/SMA source, so it may be shared with another CDI and already processed
+        fpr_file = getattr(self.fpr, 'filepaths', None) if self.fpr.processed else self.fpr.download()
 
         return [spi_file, sma_file, fpr_file]
 
@@ -1625,11 +1651,17 @@ class CDI(DroughtIndex):
         # Process individual indices
         self.spi.process()
         self.sma.process()
-        self.fpr.process()
+        if not self.fpr.processed:
+            self.fpr.process()
 
         da_spi = self.spi.data_ds[self.args.spi_var]
         da_sma = self.sma.data_ds[self.args.sma_var]
-        da_fpr = self.fpr.data_ds[self.args.fpr_var]
+        # A shared fAPAR restored from a cache only holds its dataframe, so build the array from that
+        # rather than processing (and so modifying) the shared index again
+        if self.args.fpr_var in self.fpr.data_ds:
+            da_fpr = self.fpr.data_ds[self.args.fpr_var]
+        else:
+            da_fpr = self.fpr.data_df.set_index(['time', 'latitude', 'longitude'])[self.args.fpr_var].to_xarray()
 
         # Interpolate SMA and FPR to same grid as CDI
         if not (self.sstype.value is SSType.POINT.value):
@@ -1698,6 +1730,7 @@ class CDI(DroughtIndex):
                        'CDI': cdi})
         self.data_ds = self.ds_reindexed.assign(CDI=cdi)
         self.data_df = self.data_ds.to_dataframe().reset_index()
+        self.processed = True
 
         self.generate_output()
 
@@ -1849,8 +1882,7 @@ class UTCI(DroughtIndex):
             # print("ECMWF ds: ",ds)
 
         else:
-            spi_vals = xr.apply_ufunc(spi.calc_spi, da, input_core_dims=[['time']], output_core_dims=[['time']],
-                                      vectorize=True)
+            spi_vals = spi.calc_spi_grid(da)
 
             # Store spi
             ds = xr.Dataset(data_vars={'tp': da, 'spi': spi_vals})
@@ -2023,6 +2055,7 @@ class UTCI(DroughtIndex):
         # store processed data on object
         self.data_ds = ds_reindexed
         self.data_df = df_reindexed
+        self.processed = True
 
         self.generate_output()
 
@@ -1,12 +1,16 @@
+import functools
+import itertools
 import logging
 import os
+import threading
 from os.path import expanduser
 from typing import List
 from datetime import date, time
 import numpy as np
+import pandas as pd
 # handling NetCDF files
 import xarray as xr
-from climate_drought import utils, config
+from climate_drought import config
 # ERA download
 from pixutils import era_download
 # AWS ERA5 data access - changed as casuing issues when reading NetCDFs
@@ -20,12 +24,17 @@ import pathlib
 import ujson
 import zarr
 from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
 
 # Logging
 logging.basicConfig(level=logging.INFO)
 
 # Shared constants
 BOX_SIZE = 0.1
+# The CDS queue runs a handful of jobs per user concurrently
+CDS_WORKERS = 5
+# Long-lived pool for CDS requests; threads are only started on first use
+CDS_POOL = ThreadPoolExecutor(max_workers=CDS_WORKERS, thread_name_prefix='cds')
 
 PRECIP_VARIABLES = ['total_precipitation']
 SOILWATER_VARIABLES = ["volumetric_soil_water_layer_1", "volumetric_soil_water_layer_2",
@@ -41,6 +50,39 @@ AWSKEY = os.path.join(expanduser('~'), '.aws_api_key')
 AWS_PRECIP_VARIABLE = ['precipitation_amount_1hour_Accumulation']
 
 
+# Local Dask cluster, shared by every AWS download in the process
+DASK_CLIENT = None
+DASK_LOCK = threading.Lock()
+
+
+def dask_client() -> Client:
+    """
+    Returns the shared Dask client, starting it on first use
+    :return: Dask distributed client
+    """
+    global DASK_CLIENT
+    with DASK_LOCK:
+        if DASK_CLIENT is None:
+            DASK_CLIENT = Client(n_workers=8)
+    return DASK_CLIENT
+
+
+def collapse_expver(ds: xr.Dataset) -> xr.Dataset:
+    """
+    Collapses the ERA5 / ERA5T experiment version dimension, which the CDS only adds to chunks spanning recent data
+    :param ds: dataset read from a single CDS download
+    :return: dataset without an expver dimension, taking the first valid value at each point
+    """
+    if 'expver' in ds.dims:
+        merged = ds.isel(expver=0, drop=True)
+        for i in range(1, ds.sizes['expver']):
+            merged = merged.combine_first(ds.isel(expver=i, drop=True))
+        ds = merged
+    elif 'expver' in ds.variables:
+        ds = ds.drop_vars('expver')
+    return ds
+
+
 class Freq(Enum):
     MONTHLY = 'monthly'
     DAILY = 'daily'
@@ -88,16 +130,9 @@ class ERA5Download():
         self.req = req
 
         # Create list of dates between max start and end dates
-        dates = utils.daterange(self.req.start_date, self.req.end_date, 0)
-        date_list = []
-        for indate in dates:
-            yyyy = int(indate[0:4])
-            mm = int(indate[4:6])
-            dd = int(indate[6:8])
-            date_list.append(date(yyyy, mm, dd))
-        self.dates = date_list
-
-    @property
+        self.dates = pd.date_range(start=self.req.start_date, end=self.req.end_date, freq='D').date.tolist()
+
+    @functools.cached_property
     def download_file_path(self):
         """
         Returns the path to the file that will be downloaded
@@ -188,13 +223,31 @@ class ERA5Download():
 
             self.logger.info(
                 "Downloading {} ERA data for {} {} for {}".format(frequency.value, dates[0], dates[-1], area))
-            result = era_download.download_era5_reanalysis_data(dates=dates,
-                                                                times=times, variables=variables, area=str(area),
-                                                                frequency=frequency.value,
-                                                                file_path=os.path.expanduser(out_file))
 
-            if result == 0:
-                raise RuntimeError("Download process returned unexpected non-zero exit code '{}'.".format(result))
+            # Daily and hourly requests are split into monthly chunks so the CDS can run them concurrently
+            if frequency == Freq.MONTHLY:
+                chunks = [dates]
+            else:
+                chunks = [list(g) for _, g in itertools.groupby(dates, key=lambda d: (d.year, d.month))]
+
+            if len(chunks) == 1:
+                self._request_era5_data(variables, dates, times, area, frequency, out_file)
+            else:
+                part_files = ["{}_part{:03d}.nc".format(os.path.splitext(out_file)[0], i) for i in range(len(chunks))]
+                list(CDS_POOL.map(lambda c, f: self._request_era5_data(variables, c, times, area, frequency, f),
+                                  chunks, part_files))
+
+                # Merge the monthly chunks into the single expected output file
+                merged_file = "{}.{}.tmp.nc".format(os.path.splitext(out_file)[0], os.getpid())
+                try:
+                    with xr.open_mfdataset(part_files, combine='by_coords', preprocess=collapse_expver) as ds:
+                        ds.to_netcdf(merged_file)
+                    os.replace(merged_file, out_file)
+                finally:
+                    if os.path.exists(merged_file):
+                        os.remove(merged_file)
+                for part_file in part_files:
+                    os.remove(part_file)
 
         else:
             self.logger.info("Download file '{}' already exists.".format(out_file))
@@ -205,6 +258,39 @@ class ERA5Download():
 
         return outfile_exists
 
+    def _request_era5_data(self, variables: List[str], dates: List[date], times: List[time], area: List[float],
+                           frequency: Freq, out_file: str):
+        """
+        Submits a single ERA5 request to the Copernicus Climate Data Store, skipped if the file already exists.
+        :param variables: a list of variables to be downloaded
+        :param dates: a list of dates to download data for
+        :param times: a list of times to download data for
+        :param area: area of interest box to download data for
+        :param frequency: frequency of data to be downloaded
+        :param out_file: path to the NetCDF file to write
+        :return: nothing
+        """
+        if os.path.exists(out_file):
+            return
+
+        # Download under a temporary name (keeping the .nc extension that sets the format) and only rename once
+        # complete, so an interrupted download is never mistaken for a finished one
+        out_file = os.path.expanduser(out_file)
+        tmp_file = "{}.{}.tmp.nc".format(os.path.splitext(out_file)[0], os.getpid())
+        try:
+            result = era_download.download_era5_reanalysis_data(dates=dates,
+                                                                times=times, variables=variables, area=str(area),
+                                                                frequency=frequency.value,
+                                                                file_path=tmp_file)
+
+            if result == 0:
+                raise RuntimeError("Download process returned unexpected non-zero exit code '{}'.".format(result))
+
+            os.replace(tmp_file, out_file)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
     # Created with reference to https://medium.com/pangeo/fake-it-until-you-make-it-reading-goes-netcdf4-data-on-aws-s3-as-zarr-for-rapid-data-access-61e33f8fe685
     def _download_aws_data(self, area: List[float], out_file: str) -> bool:
 
@@ -276,9 +362,8 @@ class ERA5Download():
                 for u in urls:
                     gen_json(u)
             else:
-                # Start a Dask client
-                client = Client(n_workers=8)
-                client
+                # Start the Dask client once and reuse it for later requests
+                dask_client()
                 dask.compute(*[dask.delayed(gen_json)(u) for u in urls])
 
             def modify_fill_value(out):
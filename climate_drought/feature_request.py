@@ -3,6 +3,7 @@ import os
 from typing import List
 from datetime import date, time
 import numpy as np
+import pandas as pd
 # Configuration
 from climate_drought import utils, config
 # Feature download
@@ -59,14 +60,7 @@ class FeatureDownload():
         self.req = req
 
         # Create list of dates between max start and end dates
-        dates = utils.daterange(self.req.start_date, self.req.end_date, 0)
-        date_list = []
-        for indate in dates:
-            yyyy = int(indate[0:4])
-            mm = int(indate[4:6])
-            dd = int(indate[6:8])
-            date_list.append(date(yyyy, mm, dd))
-        self.dates = date_list
+        self.dates = pd.date_range(start=self.req.start_date, end=self.req.end_date, freq='D').date.tolist()
 
     def download(self) -> str:
         """
@@ -1,13 +1,91 @@
 import os
+import re
 import logging
+import tempfile
 
-import glob
-from urllib.request import urlopen, urlretrieve
-import ssl
+import xarray as xr
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
 
 
 URL="https://edo.jrc.ec.europa.eu/gdo/php/util/getData2download.php?year={year}&scale_id=gdo&prod_code={prod_code}&format=nc&action=getUrls"
 
+# Shared session so the URL lookups and file downloads for every year reuse pooled connections
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_maxsize=10))
+# The GDO file server is downloaded from without certificate verification, as it always has been,
+# so silence the warning that would otherwise be repeated for every file
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+# NetCDF file names per folder, with the folder modification time they were read at
+LISTING_CACHE = {}
+
+def list_nc_files(folder):
+    """
+    Lists the NetCDF files in a folder, only re-reading the folder when its contents have changed
+    :param folder: folder to list
+    :return: list of file names
+    """
+    if not os.path.isdir(folder):
+        return []
+    mtime = os.stat(folder).st_mtime_ns
+    cached = LISTING_CACHE.get(folder)
+    if cached is None or cached[0] != mtime:
+        with os.scandir(folder) as entries:
+            cached = (mtime, [e.name for e in entries if e.name.endswith('.nc')])
+        LISTING_CACHE[folder] = cached
+    return cached[1]
+
+def timeseries_path(filepath):
+    """
+    Path of the time-chunked copy of a downloaded GDO file, keyed on the size and modification time of the file
+    :param filepath: path to the downloaded NetCDF file
+    :return: path to the copy in the 'timeseries' subfolder
+    """
+    st = os.stat(filepath)
+    base = os.path.splitext(os.path.basename(filepath))[0]
+    return os.path.join(os.path.dirname(filepath), 'timeseries', "{}_{}-{}.nc".format(base, st.st_size, st.st_mtime_ns))
+
+def write_timeseries_copy(filepath, chunk=64):
+    """
+    Writes a copy of a downloaded GDO file with each chunk holding the whole time series for a block of cells,
+    so a point time series is read with a single chunk access rather than one per time step
+    :param filepath: path to the downloaded NetCDF file
+    :param chunk: chunk size along each spatial dimension
+    :return: path to the copy
+    """
+    outfile = timeseries_path(filepath)
+    if os.path.isfile(outfile):
+        return outfile
+
+    outdir = os.path.dirname(outfile)
+    os.makedirs(outdir, exist_ok=True)
+    # Unique temporary name, so concurrent writers of the same file never share one and only a complete copy is renamed
+    with tempfile.NamedTemporaryFile(dir=outdir, suffix='.tmp', delete=False) as tmp:
+        tmpfile = tmp.name
+    try:
+        with xr.open_dataset(filepath) as ds:
+            encoding = {}
+            for name, var in ds.data_vars.items():
+                if 'time' in var.dims:
+                    encoding[name] = {'chunksizes': tuple(ds.sizes[d] if d == 'time' else min(chunk, ds.sizes[d])
+                                                          for d in var.dims)}
+                    var.encoding.pop('contiguous', None)
+            ds.to_netcdf(tmpfile, engine='netcdf4', format='NETCDF4', encoding=encoding)
+        os.replace(tmpfile, outfile)
+    finally:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+
+    # Remove copies of earlier versions of the file, which would otherwise pile up on each re-download
+    stale = re.compile(re.escape(os.path.splitext(os.path.basename(filepath))[0]) + r'_\d+-\d+\.nc$')
+    with os.scandir(outdir) as entries:
+        for entry in entries:
+            if stale.match(entry.name) and entry.path != outfile:
+                os.remove(entry.path)
+    return outfile
+
 class GDODownload():
     """
     Represents a single download file from the Global Drought Observatory
@@ -25,12 +103,12 @@ class GDODownload():
         self.logger = logger
 
         # Check if already downloaded first
-        files = glob.glob(os.path.join(output_folder,"{}_m_wld_{}*.nc".format(prod_code, year)))
+        # One folder listing is shared by every year rather than globbing the folder each time
+        prefix = "{}_m_wld_{}".format(prod_code, year)
+        files = [f for f in list_nc_files(output_folder) if f.startswith(prefix)]
         self.success = True
         if len(files) > 0:
-            self.files_to_download = []
-            for f in files:
-                self.files_to_download.append(os.path.basename(f))
+            self.files_to_download = files
             self.logger.info("{} already downloaded".format(self.files_to_download))
         else:
             self.logger.info("No {} file in {}".format(year, output_folder))
@@ -38,14 +116,14 @@ class GDODownload():
             # Simulate clicking the 'download' button for a given dataset and year
             url = build_url(year,prod_code)
             try:
-                page = urlopen(url)
+                page = SESSION.get(url)
+                page.raise_for_status()
             except:
                 self.logger.info("Failed to open URL: {}".format(url))
                 self.success = False
             
             if self.success:
-                html_bytes = page.read()
-                html = html_bytes.decode("utf-8")
+                html = page.content.decode("utf-8")
           
                 # html is a string of a list of strings - convert to list
                 urls = eval(html)
@@ -64,8 +142,6 @@ class GDODownload():
 
     def download(self,output_folder):
 
-        ssl._create_default_https_context = ssl._create_unverified_context
-
         self.logger.info("Downloading files to {}".format(output_folder))
         for url, filename in zip(self.urls,self.files_to_download):
             filepath = output_folder + "/" + filename
@@ -73,7 +149,12 @@ class GDODownload():
                 self.logger.info("File already exists at: {}".format(filepath))
             else:
                 try:
-                    urlretrieve(url,filename=filepath)
+                    # iter_content decodes any gzip/deflate transfer encoding before writing
+                    with SESSION.get(url, stream=True, verify=False) as r:
+                        r.raise_for_status()
+                        with open(filepath, 'wb') as f:
+                            for block in r.iter_content(chunk_size=1 << 20):
+                                f.write(block)
                     self.logger.info("Downloaded file from GDO: {}".format(filepath))
                 except Exception as e:
                     self.logger.info("Could not download file: {}".format(filepath))
@@ -1,5 +1,6 @@
 
 import numpy as np
+import xarray as xr
 from climate_indices import compute, indices, utils
 from climate_indices.compute import scale_values, Periodicity
 
@@ -64,4 +65,16 @@ class INDICES:
                 periodicity=compute.Periodicity.monthly,
                 fitting_params=gamma_params,
             )
-        return spi_gamma_3month
\ No newline at end of file
+        return spi_gamma_3month
+
+    def calc_spi_grid(self, da, chunk=50):
+        """
+        Calculates SPI for every cell of a gridded precipitation array, with blocks of cells processed in parallel by dask
+        :param da: precipitation data array with a time dimension
+        :param chunk: number of cells along each spatial dimension in a block
+        :return: data array of SPI values with the same dimensions as da
+        """
+        # Each block must hold the whole time series as SPI is fitted along time
+        chunks = {dim: (-1 if dim == 'time' else chunk) for dim in da.dims}
+        return xr.apply_ufunc(self.calc_spi, da.chunk(chunks), input_core_dims=[['time']], output_core_dims=[['time']],
+                              vectorize=True, dask='parallelized', output_dtypes=[float]).compute()
@@ -2,18 +2,30 @@ import logging
 import os
 import numpy as np
 import pandas as pd
-import geojson
+import orjson
+from scipy.spatial import cKDTree
 from climate_drought import indices
 
 # Logging
 logging.basicConfig(level=logging.INFO)
 
+# k-d trees of the SAFE point locations, keyed by file path and modification time
+TREE_CACHE = {}
+
+
+# Build, or reuse, a k-d tree over the unique lon/lat pairs of a file
+def point_tree(infile, lons, lats):
+    key = (infile, os.path.getmtime(infile))
+    if key not in TREE_CACHE:
+        coords = np.unique(np.column_stack((lons, lats)), axis=0)
+        TREE_CACHE[key] = (cKDTree(coords), coords)
+    return TREE_CACHE[key]
+
 
 # Find the closest matching lat value
-def find_nearest(lons, lats, lon0, lat0):
-    idx = ((lons - lon0) ** 2 + (lats - lat0) ** 2).argmin()
-    value_lat = lats.flat[idx]
-    value_lon = lons.flat[idx]
+def find_nearest(tree, coords, lon0, lat0):
+    _, idx = tree.query([lon0, lat0], k=1)
+    value_lon, value_lat = coords[idx]
     return value_lat, value_lon
 
 
@@ -22,9 +34,55 @@ class LoadSAFE():
     Loads a downloaded SAFE GeoJSON file
     """
 
-    def __init__(self, logger: logging.Logger, infile: False):
+    def __init__(self, logger: logging.Logger, infile: False, cache_dir=None):
         self.logger = logger
         self.infile = infile
+        # Folder for the flattened table of the file, no caching if not given
+        self.cache_dir = cache_dir
+
+    # Read all points from the SAFE software exported GeoJSON into a flat table
+    def read_safe(self):
+
+        # Reuse the flattened table from an earlier read of the same file version
+        cache_path = None
+        if self.cache_dir:
+            prefix = "safe_{}.".format(os.path.basename(self.infile))
+            cache_path = os.path.join(self.cache_dir, "{}{:.0f}.parquet".format(prefix, os.path.getmtime(self.infile)))
+            if os.path.exists(cache_path):
+                return pd.read_parquet(cache_path)
+
+        # Load data
+        with open(self.infile, 'rb') as f:
+            data = orjson.loads(f.read())
+
+        # Build the flat table straight from the feature properties rather than normalising every nested field.
+        # Exploding the coordinates and keeping element 1 left one row per feature with at least two coordinates
+        features = data["features"]
+        keep = np.flatnonzero([len(f['geometry']['coordinates']) > 1 for f in features])
+        df_safe = pd.DataFrame.from_records([features[i]['properties'] for i in keep], index=keep,
+                                            columns=['_date', 'precipTotalMon', '_x', '_y'])
+        df_safe = df_safe.rename(columns={'_date': 'time', 'precipTotalMon': 'tp_orig',
+                                          '_x': 'longitude', '_y': 'latitude'})
+
+        # Convert units for precipitation from mm/day to m, in one float32 pass
+        df_safe['tp'] = np.multiply(df_safe.pop('tp_orig').to_numpy(dtype=np.float32), np.float32(1.0 / 24000.0))
+
+        # Convert time, with a format hint and cache as the same dates repeat
+        df_safe['time'] = pd.to_datetime(df_safe['time'], format='%Y-%m-%d', cache=True)
+
+        # The cache is only an optimisation, so carry on without it if the folder can't be written
+        if cache_path is not None:
+            try:
+                df_safe.to_parquet(cache_path, compression='zstd')
+                # Remove tables of earlier versions of the file
+                with os.scandir(self.cache_dir) as entries:
+                    for entry in entries:
+                        if entry.name.startswith(prefix) and entry.path != cache_path:
+                            os.remove(entry.path)
+            except OSError as e:
+                self.logger.warning("Could not cache SAFE table in {}: {}".format(self.cache_dir, e))
+
+        return df_safe
 
     # Load Canadian RCP data from SAFE software exported GeoJSON
     def load_safe(self, df_spi, lat_val=50.0, lon_val=-97.5):
@@ -39,66 +97,31 @@ class LoadSAFE():
 
         else:
 
-            # Load data
-            with open(self.infile) as f:
-                data = geojson.load(f)
-
-            # Normalize JSON data into a flat table
-            df = pd.json_normalize(data["features"])
-
-            # Extract data from features?
-            coords = 'geometry.coordinates'
-            df_interim = (df[coords].apply(pd.Series).stack()
-                          .reset_index(level=1).rename(columns={0: coords, "level_1": "point"})
-                          .join(df.drop(coords, 1), how='left'))
-
-            # Select specific columns and then rename
-            columns = ['point', 'properties._date', 'properties.precipTotalMon', 'properties._x', 'properties._y']
-            df_safe = pd.DataFrame(df_interim, columns=columns)
-            df_safe.rename(columns={'properties._date': 'time', 'properties.precipTotalMon': 'tp_orig',
-                                    'properties._x': 'longitude', 'properties._y': 'latitude'}, inplace=True)
+            # Read the file
+            df_safe = self.read_safe()
 
-            # Reduce to only the points with value 1
-            df_safe = df_safe.loc[(df_safe['point'] == 1)]
-            df_safe = df_safe.drop('point', 1)
+            # Extract closest lat/lon
+            lons = df_safe.longitude.to_numpy()
+            lats = df_safe.latitude.to_numpy()
+            tree, points = point_tree(self.infile, lons, lats)
+            latv, lonv = find_nearest(tree, points, lon_val, lat_val)
 
-            # Convert units for precipitation from mm/day to m
-            tp = df_safe.tp_orig.values / 1000.0 / 24.0
-            df_safe['tp'] = tp
-            df_safe['tp'] = df_safe['tp'].astype('float32')
-            df_safe = df_safe.drop('tp_orig', 1)
-
-            # Convert to xarray, extract closest lat/lon
-            datxr = df_safe.to_xarray()
-            latv, lonv = find_nearest(datxr.longitude.values, datxr.latitude.values, lon_val, lat_val)
-
-            # Drop latitude/longitude when not the requested values
-            datxr = datxr.where((datxr.latitude == latv) & (datxr.longitude == lonv), drop=True)
-
-            # Convert back to dataframe
-            df_safe = datxr.to_dataframe()
-
-            # Drop origin lat/lon and add specified, so consistent with ECMWF
-            df_safe = df_safe.drop('latitude', 1).drop('longitude', 1)
+            # Keep only rows at the closest lat/lon, then drop origin lat/lon and add specified, so consistent with ECMWF
+            mask = (lats == latv) & (lons == lonv)
+            df_safe = df_safe.loc[mask].drop(columns=['latitude', 'longitude'])
             df_safe['latitude'] = lat_val
             df_safe['longitude'] = lon_val
 
-            # Convert time then set as index
-            # df_safe['time'] = df_safe['time'].astype('datetime64')
-            # df_safe = df_safe.set_index('time')
-
             # Add df_safe to existing df_spi dataset and extract precip
             print("df_safe: ", df_safe)
-            df_spi = df_spi.drop('spi', 1)
+            df_spi = df_spi.drop(columns=['spi'], errors='ignore')
             print("df_spi: ", df_spi)
             df = pd.concat([df_spi, df_safe])
             self.logger.info("SAFE Climate scenario extension, df: ", df)
 
             # Calculate SPI
             spi = indices.INDICES()
-            datxr = df.to_xarray()
-            precip = datxr.tp.load()
-            spi_vals = spi.calc_spi(np.array(precip.values).flatten())
+            spi_vals = spi.calc_spi(df['tp'].to_numpy())
             self.logger.info(
                 "SPI, {} values: {:.3f} {:.3f}".format(len(spi_vals), np.nanmin(spi_vals), np.nanmax(spi_vals)))
 
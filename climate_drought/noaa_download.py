@@ -1,11 +1,19 @@
-import ssl
+import shutil
 
-from urllib.request import urlretrieve
-from datetime import datetime
+import requests
 from enum import Enum
 
 URL_POSITION = "https://edr-api-c.mdl.nws.noaa.gov/Climate-EDR//collections/{collection}/position?coords=POINT({lon}%20{lat})&parameter-name={param}&datetime={start}/{end}&crs=EPSG:4326&f=csv"
 
+# Shared session so repeated point requests reuse the connection
+SESSION = requests.Session()
+
+def str2dt(s: str) -> str:
+    """
+    Converts a 'YYYYMMDD' date string to the ISO 8601 form used in the request URL
+    """
+    return f"{s[0:4]}-{s[4:6]}-{s[6:8]}T00:00:00Z"
+
 class NClimGridParams(Enum):
     PRECIPITATION = 'prcp'
     TEMPERATURE_MAX = 'tmax'
@@ -18,15 +26,17 @@ def get_nclimgrid(lon, lat, start: str, end: str, param: NClimGridParams, out_fi
     :param start: the start date in the format 'YYYYMMDD'
     :param end: the end date in the format 'YYYYMMDD'
     """
-    str2dt = lambda str: datetime(int(str[0:4]),int(str[4:6]),int(str[6:8]),0,0,0).strftime("%Y-%m-%dT%H:%M:%SZ")
-
-    urlretrieve(
-        URL_POSITION.format(
+    url = URL_POSITION.format(
             collection='nclimgrid-monthly',
             lon=lon, lat=lat,
             param=param.value,
             start=str2dt(start),
-            end=str2dt(end)),
-        out_filepath)
-    
-    return out_filepath
\ No newline at end of file
+            end=str2dt(end))
+
+    with SESSION.get(url, stream=True, headers={'Accept-Encoding': 'gzip'}) as r:
+        r.raise_for_status()
+        r.raw.decode_content = True
+        with open(out_filepath, 'wb') as f:
+            shutil.copyfileobj(r.raw, f)
+
+    return out_filepath
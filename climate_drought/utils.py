@@ -1,30 +1,51 @@
 
-import datetime
+import functools
+from dataclasses import dataclass
+
 import pandas as pd
 import xarray as xr
 import numpy as np
 import matplotlib.pyplot as plt
 
-from shapely import Polygon, box
+import shapely
+from shapely.geometry import Polygon
+
+# Vectorised geometry constructors and predicates need shapely 2.0
+SHAPELY2 = int(shapely.__version__.split('.')[0]) >= 2
+
+# numba only speeds up the compiled helpers (the shapely < 2.0 polygon mask and level runs), which run as plain Python without it
+try:
+    from numba import njit, prange
+except ImportError:
+    prange = range
+
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+# Days since the start of the dekad, indexed by day of month (index 0 unused)
+DEKAD_OFFSET = np.array([0] + [day - min((day-1) // 10, 2)*10 - 1 for day in range(1, 32)], dtype='int8')
 
 
 # Calculate overlap between two bounding boxes
 def calculate_iou(bbox_1, bbox_2):
 
-    box_1 = box(bbox_1[0],bbox_1[1],bbox_1[2],bbox_1[3])
-    box_2 = box(bbox_2[0],bbox_2[1],bbox_2[2],bbox_2[3])
-    overlap = box_1.intersection(box_2).area
-    union = box_1.union(box_2).area
+    # Axis-aligned boxes, so the overlap is plain rectangle arithmetic without GEOS
+    ix = max(0, min(bbox_1[2], bbox_2[2]) - max(bbox_1[0], bbox_2[0]))
+    iy = max(0, min(bbox_1[3], bbox_2[3]) - max(bbox_1[1], bbox_2[1]))
+    overlap = ix * iy
+    area_1 = (bbox_1[2] - bbox_1[0]) * (bbox_1[3] - bbox_1[1])
+    area_2 = (bbox_2[2] - bbox_2[0]) * (bbox_2[3] - bbox_2[1])
+    union = area_1 + area_2 - overlap
     iou = overlap / union
-    #print("Bounding box, overlap {} union {} iou {}".format(box_1.intersection(box_2).area, box_1.union(box_2).area, iou))
+    #print("Bounding box, overlap {} union {} iou {}".format(overlap, union, iou))
 
     return overlap,union,iou
 
 
 def daterange(sdate, edate, rtv):
     """
-    Generates a list of date strings between two given dates using pandas.  The list is then iterated over and
-    reformatted to obtain the list of dates for usage in other programs
+    Generates a list of date strings between two given dates using pandas.  The range is formatted in a single
+    strftime call to obtain the list of dates for usage in other programs
 
     :param sdate: start date string formatted as YYYYMMDD
     :type sdate: str
@@ -37,23 +58,18 @@ def daterange(sdate, edate, rtv):
     """
 
     rng = pd.date_range(start=sdate, end=edate)
-    dates = []
-    # This first for loop takes the pandas date range and slices the date
-    # section into an integer string format i.e 20160101
-    for i in range(len(rng)):
-        t = str(rng[i])
-        if rtv == 0:
-            y = t[0:4] + t[5:7] + t[8:10]
-        elif rtv == 1:
-            fmt = "%Y-%m-%d"
-            dt = datetime.datetime.strptime(t, fmt)
-            tt = dt.timetuple()
-            if int(tt[7]) < 100:
-                y = t[0:4] + "0" + str(tt[7])
-            else:
-                y = t[0:4] + str(tt[7])
-        dates.append(y)
-    return dates
+    # Format the whole range at once i.e 20160101, or 2016001 for julian day of year
+    fmt = "%Y%j" if rtv == 1 else "%Y%m%d"
+    return rng.strftime(fmt).tolist()
+
+def dekad_start(times: np.ndarray) -> np.ndarray:
+    """
+    Utility function to map dates onto the first day of their dekad
+    :param times: numpy datetime64 array of dates
+    :return: numpy datetime64 array of the same dtype with the start date of each dekad
+    """
+    day = (times.astype('datetime64[D]') - times.astype('datetime64[M]')).astype(int) + 1
+    return times - DEKAD_OFFSET[day].astype('timedelta64[D]')
 
 def df_to_dekads(df: pd.DataFrame) -> pd.DataFrame:
     """
@@ -61,10 +77,19 @@ def df_to_dekads(df: pd.DataFrame) -> pd.DataFrame:
     :param df: pd.Dataframe with time index with a frequency > 10 days e.g. daily, hourly
     :return: dataframe with dekad frequency
     """
-    df_daily = df.resample('1D').mean()
-    d = df_daily.index.day - np.clip((df_daily.index.day-1) // 10, 0, 2)*10 - 1
-    date = df_daily.index.to_numpy() - np.array(d, dtype="timedelta64[D]")
-    return df_daily.groupby(date).mean()
+    # Daily means keyed on the truncated date, without building a regular daily index,
+    # skipped when the data already has at most one value per day at midnight
+    days = df.index.to_numpy().astype('datetime64[D]')
+    if df.index.is_unique and (df.index.to_numpy() == days).all():
+        df_daily = df
+    else:
+        df_daily = df.groupby(days).mean()
+    df_dekads = df_daily.groupby(dekad_start(df_daily.index.to_numpy())).mean()
+    if df_dekads.empty:
+        return df_dekads
+
+    # Dekads without any data are kept as NaN rows, as a resample over the full range would give
+    return df_dekads.reindex(dti_dekads(df_dekads.index[0], df_dekads.index[-1]))
 
 def ds_to_dekads(ds: xr.Dataset) -> xr.Dataset:
     """
@@ -72,10 +97,11 @@ def ds_to_dekads(ds: xr.Dataset) -> xr.Dataset:
     :param ds: xr.Dataset with time index with a frequency > 10 days e.g. daily, hourly
     :return: dataframe with dekad frequency
     """
-    ds_daily = ds.sortby('time').resample({'time':'1D'}).mean()
-    day = ds_daily.time.dt.day
-    dday = day - np.clip((day-1) // 10, 0, 2)*10 - 1
-    date = ds_daily.time - np.array(dday, dtype="timedelta64[D]")
+    # Resampling needs ordered times, but most inputs already are so avoid the rewrite
+    if not ds.indexes['time'].is_monotonic_increasing:
+        ds = ds.sortby('time')
+    ds_daily = ds.resample({'time':'1D'}).mean()
+    date = ds_daily.time.copy(data=dekad_start(ds_daily.time.values))
     ds_dekads = ds_daily.assign_coords(date=date)
     return ds_dekads.groupby(date).mean()
 
@@ -86,22 +112,23 @@ def dti_dekads(sdate,edate):
     :param edate: end date, format 'YYYYMMDD'
     :return: datetimeindex in dekads
     """
-    dti = pd.date_range(sdate,edate,freq='1D')
-    d = dti.day - np.clip((dti.day-1) // 10, 0, 2)*10 - 1
-    date = dti.values - np.array(d, dtype="timedelta64[D]")
-    return pd.DatetimeIndex(np.unique(date))
+    return pd.DatetimeIndex(dt_dekads(sdate,edate))
 
+@functools.lru_cache(maxsize=128)
 def dt_dekads(sdate,edate):
     """
     Utility function to create a datetime index list in dekads between a defined start and end date
     :param sdate: start date, format 'YYYYMMDD'
     :param edate: end date, format 'YYYYMMDD'
-    :return: datetimeindex in dekads
+    :return: read-only array of dekads, shared between calls with the same dates
     """
     dti = pd.date_range(sdate,edate,freq='1D')
-    d = dti.day - np.clip((dti.day-1) // 10, 0, 2)*10 - 1
-    date = dti.values - np.array(d, dtype="timedelta64[D]")
-    return np.unique(date)
+    date = dekad_start(dti.values)
+
+    # Days are in order, so duplicates are adjacent and no sort is needed
+    dekads = np.concatenate((date[:1], date[1:][date[1:] != date[:-1]]))
+    dekads.flags.writeable = False
+    return dekads
 
 
 def fill_gaps_df(index, df: pd.DataFrame) -> pd.DataFrame:
@@ -111,30 +138,37 @@ def fill_gaps_df(index, df: pd.DataFrame) -> pd.DataFrame:
     :param df: pd.DataFrame to be interpolated onto index
     :return: pd.DataFrame with a regular datetime index where missing data is populated with NaNs
     """
-    gaps = index[~index.isin(df.index)]
-    if len(gaps) > 0:
-        df_gaps = pd.DataFrame(index=gaps)
-        return pd.concat([df,df_gaps]).sort_index()
-    else:
+    if index.isin(df.index).all():
         return df
+    elif df.index.is_unique:
+        # Single aligned pass, new labels are filled with NaNs
+        return df.reindex(df.index.union(index))
+    else:
+        # reindex cannot handle duplicate labels, so append the gaps instead
+        df_gaps = pd.DataFrame(index=index.difference(df.index))
+        return pd.concat([df,df_gaps]).sort_index()
     
 def crop_df(df,sdate,edate) -> pd.DataFrame:
     """
     Crop a Dataframe between start and end dates
-    :param df: pandas dataframe with time index
+    :param df: pandas dataframe with time index, sorted first if needed
     :param sdate: pd.Timestamp or date format YYYYMMDD
     :param edate: pd.Timestamp or date format YYYYMMDD
     """
-    return df.loc[(df.index >= sdate) & (df.index <= edate)]
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index()
+    return df.loc[pd.Timestamp(sdate):pd.Timestamp(edate)]
 
 def crop_ds(ds,sdate,edate) -> xr.Dataset:
     """
-    Crop a Dataframe between start and end dates
-    :param ds: xarray dataset with time coordinate
+    Crop a Dataset between start and end dates
+    :param ds: xarray dataset with time coordinate, sorted first if needed
     :param sdate: date format YYYYMMDD
     :param edate: date format YYYYMMDD
     """
-    return ds.where((ds.time >= pd.Timestamp(sdate)) & (ds.time <= pd.Timestamp(edate)),drop=True)
+    if not ds.indexes['time'].is_monotonic_increasing:
+        ds = ds.sortby('time')
+    return ds.sel(time=slice(pd.Timestamp(sdate), pd.Timestamp(edate)))
 
 def mask_ds_bbox(ds,minlon,maxlon,minlat,maxlat,ds_lon_name='lon',ds_lat_name='lat'):
     """
@@ -147,10 +181,123 @@ def mask_ds_bbox(ds,minlon,maxlon,minlat,maxlat,ds_lon_name='lon',ds_lat_name='l
     :param ds_lat_name: ds coordinate label for latitude if not 'lat'
     :param ds_lon_name: ds coordinate label for longitue if not 'lon'
     """
+    # Monotonic coordinates (the usual case) can be cropped positionally without touching the data
+    lon_slice = monotonic_slice(ds[ds_lon_name].to_numpy(), minlon, maxlon)
+    lat_slice = monotonic_slice(ds[ds_lat_name].to_numpy(), minlat, maxlat)
+    if lon_slice is not None and lat_slice is not None:
+        return ds.isel({ds_lon_name: lon_slice, ds_lat_name: lat_slice})
+
     valid_lon = (ds[ds_lon_name] >= minlon) & (ds[ds_lon_name] <= maxlon)
     valid_lat = (ds[ds_lat_name] >= minlat) & (ds[ds_lat_name] <= maxlat)
     return ds.where(valid_lat & valid_lon,drop=True)
 
+def monotonic_slice(coord, vmin, vmax):
+    """
+    Positional slice of a monotonic coordinate covering the values between vmin and vmax
+    :param coord: 1D array of coordinate values, ascending or descending
+    :param vmin: minimum value to include
+    :param vmax: maximum value to include
+    :return: slice, or None if the coordinate is not monotonic
+    """
+    diff = np.diff(coord)
+    if np.all(diff > 0):
+        return slice(np.searchsorted(coord, vmin, side='left'), np.searchsorted(coord, vmax, side='right'))
+    elif np.all(diff < 0):
+        n = len(coord)
+        rev = coord[::-1]
+        return slice(n - np.searchsorted(rev, vmax, side='right'), n - np.searchsorted(rev, vmin, side='left'))
+    return None
+
+
+@njit(cache=True)
+def points_in_ring(xs, ys, rx, ry):
+    """
+    Crossing-number point in polygon test
+    :param xs: x coordinates of the points to test
+    :param ys: y coordinates of the points to test
+    :param rx: x coordinates of the polygon ring
+    :param ry: y coordinates of the polygon ring
+    :return: boolean array, True where the point is inside the ring
+    """
+    n = len(rx)
+    inside = np.zeros(len(xs), dtype=np.bool_)
+    for k in range(len(xs)):
+        x = xs[k]
+        y = ys[k]
+        j = n - 1
+        for i in range(n):
+            if (ry[i] > y) != (ry[j] > y):
+                if x < (rx[j] - rx[i]) * (y - ry[i]) / (ry[j] - ry[i]) + rx[i]:
+                    inside[k] = not inside[k]
+            j = i
+    return inside
+
+
+@njit(cache=True)
+def segment_in_box(x1, y1, x2, y2, xmin, ymin, xmax, ymax):
+    """
+    Liang-Barsky test for whether a line segment touches an axis-aligned box
+    """
+    t0 = 0.0
+    t1 = 1.0
+    dx = x2 - x1
+    dy = y2 - y1
+    ps = (-dx, dx, -dy, dy)
+    qs = (x1 - xmin, xmax - x1, y1 - ymin, ymax - y1)
+    for k in range(4):
+        p = ps[k]
+        q = qs[k]
+        if p == 0.0:
+            if q < 0.0:
+                return False
+        else:
+            r = q / p
+            if p < 0.0:
+                if r > t1:
+                    return False
+                elif r > t0:
+                    t0 = r
+            else:
+                if r < t0:
+                    return False
+                elif r < t1:
+                    t1 = r
+    return True
+
+
+@njit(cache=True, parallel=True)
+def cells_intersect_ring(cx, cy, hx, hy, rx, ry):
+    """
+    Test grid cells against a polygon ring, used when shapely's vectorised predicates are not available
+    :param cx: x coordinates of the cell centres
+    :param cy: y coordinates of the cell centres
+    :param hx: half the cell width
+    :param hy: half the cell height
+    :param rx: x coordinates of the polygon ring
+    :param ry: y coordinates of the polygon ring
+    :return: boolean array, True where the cell intersects the polygon
+    """
+    n = len(rx)
+    hits = np.zeros(len(cx), dtype=np.bool_)
+    for k in prange(len(cx)):
+        xmin = cx[k] - hx
+        xmax = cx[k] + hx
+        ymin = cy[k] - hy
+        ymax = cy[k] + hy
+
+        # Any polygon edge touching the cell means they intersect
+        j = n - 1
+        for i in range(n):
+            if segment_in_box(rx[j], ry[j], rx[i], ry[i], xmin, ymin, xmax, ymax):
+                hits[k] = True
+                break
+            j = i
+
+        # Otherwise the cell is either wholly inside or wholly outside, so one corner decides
+        if not hits[k]:
+            hits[k] = points_in_ring(np.array([xmin]), np.array([ymin]), rx, ry)[0]
+    return hits
+
     
 def mask_ds_poly(ds,lats,lons,grid_x,grid_y,other,ds_lat_name='lat',ds_lon_name='lon',mask_bbox=True):
     """
@@ -169,32 +316,48 @@ def mask_ds_poly(ds,lats,lons,grid_x,grid_y,other,ds_lat_name='lat',ds_lon_name=
     if mask_bbox:
         ds = mask_ds_bbox(ds,np.min(lons),np.max(lons),np.min(lats),np.max(lats),ds_lon_name,ds_lat_name)
 
-    # Create a polygon of the area to be masked
+    # Create a polygon of the area to be masked, prepared as it is tested against many cells
     pn = Polygon(tuple([(x,y) for x,y in zip(lons,lats)]))
+    if SHAPELY2:
+        shapely.prepare(pn)
 
     xnp = ds[ds_lon_name].to_numpy()
     ynp = ds[ds_lat_name].to_numpy()
 
-    def polycell(x,y):
-        """
-        Create a new polygon representing the grid cell with centre x,y
-        """
-        tl = (x-grid_x/2,y+grid_y/2)
-        tr = (x+grid_x/2,y+grid_y/2)
-        bl = (x-grid_x/2,y-grid_y/2)
-        br = (x+grid_x/2,y-grid_y/2)
-        return Polygon((tl,tr,br,bl))
-    
-    mask = np.ones((len(ynp),len(xnp))) * np.nan
-    for i,x in (enumerate(xnp)):
-        for j,y in enumerate(ynp):
-            pc = polycell(x,y)
-            mask[j,i]=pn.overlaps(pc) or pn.intersects(pc)
-    
-    # Assign a mask to the ds
-    ds['mask'] = ((ds_lat_name,ds_lon_name),mask)
+    # Only cells whose extent touches the polygon bounds can intersect it
+    xx, yy = np.meshgrid(xnp, ynp)
+    hx, hy = grid_x/2, grid_y/2
+    minx, miny, maxx, maxy = pn.bounds
+    candidate = (xx+hx >= minx) & (xx-hx <= maxx) & (yy+hy >= miny) & (yy-hy <= maxy)
+
+    # A cell whose centre lies inside the polygon intersects it, so only the rest need a geometry test
+    rx, ry = np.asarray(lons, dtype=float), np.asarray(lats, dtype=float)
+    cx, cy = xx[candidate], yy[candidate]
+    hits = points_in_ring(cx, cy, rx, ry)
+    cx, cy = cx[~hits], cy[~hits]
 
-    if ds.mask.any():
+    # Test the remaining cells against the polygon (overlapping cells also intersect)
+    if SHAPELY2:
+        # Corners of the remaining candidate grid cells, ordered tl, tr, br, bl
+        corners = np.stack([np.stack([cx-hx, cy+hy], axis=-1),
+                            np.stack([cx+hx, cy+hy], axis=-1),
+                            np.stack([cx+hx, cy-hy], axis=-1),
+                            np.stack([cx-hx, cy-hy], axis=-1)], axis=-2)
+
+        # Build all cells in one call and evaluate the predicate in a single sweep
+        cells = shapely.polygons(shapely.linearrings(corners))
+        hits[~hits] = shapely.intersects(pn, cells)
+    else:
+        # Older shapely has no vectorised predicates, so test the cells in a compiled loop
+        hits[~hits] = cells_intersect_ring(cx, cy, hx, hy, rx, ry)
+
+    mask = np.zeros(xx.shape, dtype=bool)
+    mask[candidate] = hits
+    
+    # Check the numpy mask directly rather than through xarray
+    if mask.any():
+        # Assign a mask to the ds
+        ds['mask'] = ((ds_lat_name,ds_lon_name),mask)
         rtn = ds.where(ds.mask,other=other,drop=True)
     else:
         print('No latitudes or longnitudes fall within the specified area')
@@ -202,29 +365,59 @@ def mask_ds_poly(ds,lats,lons,grid_x,grid_y,other,ds_lat_name='lat',ds_lon_name=
 
     return rtn
 
+@njit(cache=True)
+def level_runs(vals):
+    """
+    Single pass over a series of category levels, finding each run of equal consecutive values
+    :param vals: float array of levels, NaNs never join a run
+    :return: start index, end index (inclusive) and level of each run
+    """
+    n = len(vals)
+    starts = np.empty(n, dtype=np.int64)
+    ends = np.empty(n, dtype=np.int64)
+    levels = np.empty(n, dtype=vals.dtype)
+    k = 0
+    i = 0
+    while i < n:
+        j = i
+        while j + 1 < n and vals[j + 1] == vals[i]:
+            j += 1
+        starts[k] = i
+        ends[k] = j
+        levels[k] = vals[i]
+        k += 1
+        i = j + 1
+    return starts[:k], ends[:k], levels[:k]
+
 def nearest_dekad(day: int) -> int:
     return 1 if day<11 else (11 if day<21 else 21)
 
-def regrid_like(da,da_like,xy_label=['longitude','latitude']):
+def regrid_like(da,da_like,xy_label=['longitude','latitude'],skipna=True):
+    """
+    Coarsen a DataArray by block averaging to approximately the grid of another
+    :param da: xr.DataArray to coarsen
+    :param da_like: xr.DataArray on the target grid
+    :param xy_label: names of the x and y coordinates
+    :param skipna: set False for grids known to be NaN free to use the plain mean
+    """
     xc = int(np.floor(len(da[xy_label[0]])/len(da_like[xy_label[0]])))
     yc = int(np.floor(len(da[xy_label[1]])/len(da_like[xy_label[1]])))
-    return da.coarsen({xy_label[0]:xc,xy_label[1]:yc},boundary='trim').mean()
+    return da.coarsen({xy_label[0]:xc,xy_label[1]:yc},boundary='trim').mean(skipna=skipna,keep_attrs=False)
 
+@dataclass
 class setup_args:
-    working_dir = '/data/webservice/CLIMATE'
-    indir = '/data/webservice/CLIMATE/input'
-    outdir = '/data/webservice/CLIMATE'
-    verbose=True
-    accum=True
-    latitude=52.5
-    longitude=1.25
-    index='SPI'
-    plot=False
-    type='none'
-    start_date = '20200101'
-    end_date = '20231231'
-    aws = False
-    oformat = "GeoJSON"
-    sma_source = "GDO"
-
-
+    working_dir: str = '/data/webservice/CLIMATE'
+    indir: str = '/data/webservice/CLIMATE/input'
+    outdir: str = '/data/webservice/CLIMATE'
+    verbose: bool = True
+    accum: bool = True
+    latitude: float = 52.5
+    longitude: float = 1.25
+    index: str = 'SPI'
+    plot: bool = False
+    type: str = 'none'
+    start_date: str = '20200101'
+    end_date: str = '20231231'
+    aws: bool = False
+    oformat: str = "GeoJSON"
+    sma_source: str = "GDO"
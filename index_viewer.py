@@ -1,18 +1,22 @@
 import logging
 import datetime
-import logging
 import numpy as np
 import pandas as pd
+import os
 import io
-import cv2
+import hashlib
 from PIL import Image
 import streamlit as st
-import matplotlib.pyplot as plt
+import matplotlib
+# Figures only ever go to images, so use the non-interactive backend
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
+import matplotlib.dates as mdates
 import plotly.graph_objects as go
 from typing import List
 
 # Links from Climate-drought repository
-from climate_drought import config, drought_indices as dri
+from climate_drought import config, drought_indices as dri, utils
 from climate_drought import load_feature_file as local
 
 # Logging
@@ -37,8 +41,11 @@ DOWNLOADED = {'SE England, 2020-2022':config.AnalysisArgs(52.5,1.25,'20200121','
               'Canada Pilot Report, 2020-2022': config.AnalysisArgs(55.5, -99.1, '20200131', '20221231',singleval=True),
                   'Canada with Safe extraction of climate forecast data, 2022-2022+': config.AnalysisArgs(50.06, -97.49, '20220131', '20221231',singleval=True)}
 
-SMA_LEVEL_DEFAULT = 'zscore_swvl3'
+# Last date covered by the SAFE climate scenario data
+SAFE_END_DATE = '20241231'
 
+# Bump when index processing changes, so Parquet caches written by older code are not reused
+CACHE_VERSION = 1
 
 SMA_LEVEL_DEFAULT = 'zscore_swvl3'
 
@@ -48,82 +55,178 @@ RESTRICT_DATA_SELECTION = True
 st.set_page_config(layout="wide")
 
 
-def plot(df:pd.DataFrame,varnames:List[str],title:str,showmean=False,warning=0,warning_var=None):
+def df_fingerprint(df:pd.DataFrame,columns:List[str]):
+    """
+    Cheap stable key for the columns of a DataFrame that a plot reads, so cached figures survive DataFrames being rebuilt
+    """
+    h = hashlib.blake2b(digest_size=8)
+    for col in columns:
+        h.update(np.ascontiguousarray(df[col].values).tobytes())
+    return len(df), h.hexdigest()
 
-    fig, ax = plt.subplots(figsize=(10,3))
+def plot_data(df:pd.DataFrame,varnames:List[str],showmean=False,warning=0,warning_var=None):
+    """
+    Extracts the arrays needed to draw a time series plot
+    """
     time = df.time.values
+    # One block for all the plotted columns, NaN-skipping means to match pandas
+    series = df[varnames].to_numpy()
+    means = np.nanmean(series, axis=0) if showmean else None
+    # Compare on the raw array, NaNs compare False
+    markwarning = df[warning_var].to_numpy() < warning if not warning==0 else None
+
+    return time, series, means, markwarning
+
+def get_cdi_runs(cdi:pd.DataFrame):
+    """
+    Runs of equal CDI level, as (colour, ((start, width), ...)) per level in matplotlib date units
+    """
+    x = mdates.date2num(cdi.time.values)
+    starts, ends, levels = utils.level_runs(cdi['CDI'].to_numpy(dtype=np.float64))
+
+    cdi_runs = []
+    for level,colour in enumerate([C_WATCH,C_WARNING,C_ALERT1,C_ALERT2],start=1):
+        run = levels == level
+        cdi_runs.append((colour, tuple(zip(x[starts[run]].tolist(), (x[ends[run]] - x[starts[run]]).tolist()))))
+    return tuple(cdi_runs)
+
+def plot(df:pd.DataFrame,varnames:List[str],title:str,showmean=False,warning=0,warning_var=None,xlim=None,cdi_runs=None):
+    # Only the visible window is drawn, so drop the rest of the history before hashing and plotting
+    if xlim is not None:
+        if df.time.is_monotonic_increasing:
+            time = df.time.values
+            i0 = np.searchsorted(time, xlim[0].to_datetime64(), side='left')
+            i1 = np.searchsorted(time, xlim[1].to_datetime64(), side='right')
+            df = df.iloc[i0:i1]
+        else:
+            df = df.loc[(df.time >= xlim[0]) & (df.time <= xlim[1])]
+
+    fig = draw_plot(df,varnames,title,showmean,warning,warning_var,xlim,cdi_runs)
+
+    # A new Figure is built on every call, as one Figure can't be drawn by several sessions at once.
+    # Its label carries a fingerprint of what it shows, so the download can tell when the plots have changed
+    columns = list(dict.fromkeys(['time'] + varnames + ([warning_var] if warning_var else [])))
+    key = repr((df_fingerprint(df,columns),varnames,title,showmean,warning,warning_var,xlim,cdi_runs))
+    fig.set_label(hashlib.blake2b(key.encode(), digest_size=8).hexdigest())
+    return fig
 
-    for var in varnames:
+def draw_plot(df:pd.DataFrame,varnames:List[str],title:str,showmean,warning,warning_var,xlim,cdi_runs):
+
+    time, series, means, markwarning = plot_data(df,varnames,showmean,warning,warning_var)
+
+    # Built outside pyplot so figures are not also held in pyplot's global figure list
+    fig = Figure(figsize=(10,3))
+    ax = fig.subplots()
+
+    for j,var in enumerate(varnames):
         #st.info("{} {} {}".format(var, time, df[var]))
+        legend = var + (' ('+ r'$\bar{x}$' + ' = {mean:.2f})'.format(mean=means[j]) if showmean else '')
+        im1 = ax.plot(time,series[:,j],label=legend)
         if showmean:
-            var_mean = df[var].mean()
-        legend = var + (' ('+ r'$\bar{x}$' + ' = {mean:.2f})'.format(mean=var_mean) if showmean else '')
-        im1 = ax.plot(time,df[var],label=legend)
-        if showmean:
-            im2 = ax.plot(time,[var_mean for _ in time],c=im1[0].get_color())
+            ax.axhline(means[j],color=im1[0].get_color(),linestyle='--')
 
     ax.set_title(title)
     ax.grid()
-    ax.set_xlim([pd.Timestamp(aa.start_date), pd.Timestamp(aa.end_date)])
+    if xlim is not None:
+        ax.set_xlim(xlim)
     
     if len(varnames) > 1:
         ax.legend()
 
-    if plot_cdi:
-        markwatch = cdi['CDI'] == 1
-        markwarning = cdi['CDI'] == 2
-        markalert1 = cdi['CDI'] == 3
-        markalert2 = cdi['CDI'] == 4
-
+    if cdi_runs is not None:
+        # Each run of a CDI level is drawn as a single rectangle
         lims = ax.get_ylim()
-        h1 = ax.fill_between(time, *[-4,4], where=markwatch, facecolor=C_WATCH, alpha=.2)
-        h2 = ax.fill_between(time, *[-4,4], where=markwarning, facecolor=C_WARNING, alpha=.2)
-        h3 = ax.fill_between(time, *[-4,4], where=markalert1, facecolor=C_ALERT1, alpha=.2)
-        h4 = ax.fill_between(time, *[-4,4], where=markalert2, facecolor=C_ALERT2, alpha=.2)
+        handles = []
+        for colour,xranges in cdi_runs:
+            handles.append(ax.broken_barh(list(xranges), (-4, 8), facecolor=colour, alpha=.2))
 
         ax.set_ylim(lims)
 
-        ax.legend(handles=[h1,h2,h3,h4],labels=['Watch','Warning','Alert 1','Alert 2'])
+        ax.legend(handles=handles,labels=['Watch','Warning','Alert 1','Alert 2'])
 
-    elif not warning==0: 
-        markwarning = df[warning_var] < warning
+    elif markwarning is not None: 
         lims = ax.get_ylim()
-        ax.fill_between(time, *[-4,4], where=markwarning, facecolor='red', alpha=.2)
+        ax.fill_between(time, -4, 4, where=markwarning, facecolor='red', alpha=.2)
         ax.set_ylim(lims)
 
     return fig
 
-@st.cache(hash_funcs={dri.DroughtIndex: id},allow_output_mutation=True)
+def source_files(idx: dri.DroughtIndex):
+    """
+    Files an index is processed from, including those of any indices it combines
+    """
+    files = []
+    if isinstance(idx,dri.GDODroughtIndex):
+        files += [idx.fileloc + "/" + f for dl in idx.files for f in dl.files_to_download]
+    files += [obj.download_file_path for obj in vars(idx).values() if hasattr(obj,'download_file_path')]
+    if isinstance(getattr(idx,'filename',None),str):
+        files.append(idx.filename)
+    for part in index_parts(idx)[1:]:
+        files += source_files(part)
+    return files
+
+def index_cache_path(idx: dri.DroughtIndex,cfg: config.Config):
+    """
+    Parquet file holding the processed data of an index, named from a hash of everything that defines it,
+    including the modification times of its source files so a re-downloaded source is processed again
+    """
+    mtimes = [(f, os.path.getmtime(f) if os.path.isfile(f) else None) for f in source_files(idx)]
+    key = repr((CACHE_VERSION, type(idx).__name__, sorted(vars(idx.args).items()), cfg.baseline_start, cfg.baseline_end, mtimes))
+    return os.path.join(cfg.outdir, 'cache_{}.parquet'.format(hashlib.blake2b(key.encode(), digest_size=8).hexdigest()))
+
+def index_parts(idx: dri.DroughtIndex):
+    """
+    The index itself plus any indices it combines (e.g. the SPI, SMA and fAPAR of the CDI), which the viewer also reads
+    """
+    return [idx] + [getattr(idx,part) for part in ['spi','sma','fpr'] if isinstance(getattr(idx,part,None),dri.DroughtIndex)]
+
+# Index classes are hashed by name, the returned objects are shared rather than copied
+@st.cache_resource(max_entries=16,hash_funcs={type(dri.DroughtIndex): lambda cls: cls.__qualname__})
 def load_index(index: dri.DroughtIndex,cfg: config.Config,aa:config.AnalysisArgs):
-    idx = index(cfg,aa)
+    return prepare_index(index(cfg,aa),cfg)
+
+def prepare_index(idx: dri.DroughtIndex,cfg: config.Config):
+    """
+    Download and process an index, or restore its processed data from the Parquet cache
+    """
+    parts = index_parts(idx)
+    paths = [index_cache_path(part,cfg) for part in parts]
+
+    # Processed data persists across server restarts, so only download and process on a cold cache
+    if all(os.path.isfile(path) for path in paths):
+        for part,path in zip(parts,paths):
+            # Parts shared with another index (the fAPAR of both CDIs) may already hold their data
+            if part.data_df.empty:
+                part.data_df = pd.read_parquet(path)
+                # Only data_df is restored, data_ds stays empty
+                part.processed = True
+        return idx
+
     idx.download()
     idx.process()
+    # Name the caches from the sources as they are now downloaded
+    paths = [index_cache_path(part,cfg) for part in parts]
+    for part,path in zip(parts,paths):
+        # Leave already cached parts alone, they may be shared with another index
+        if os.path.isfile(path):
+            continue
+        # Index values are only plotted, so single precision halves what is held, cached and drawn
+        float_cols = part.data_df.select_dtypes('float64').columns
+        part.data_df = part.data_df.astype({col: np.float32 for col in float_cols})
+        part.data_df.to_parquet(path, compression='zstd')
     return idx
 
-#@st.cache(hash_funcs={pd.DataFrame: id}, allow_output_mutation=True)
-def load_indices(cdi: dri.CDI):
-
-    # Make sure everything is already downloaded else it'll take ages
-    logging.info("Calculating ECMWF SPI")
-    spi_ecmwf = load_index(dri.SPI_ECMWF,cdi.config,cdi.aa_spi)
-    logging.info("Calculating GDO SPI")
-    spi_gdo = load_index(dri.SPI_GDO,cdi.config,cdi.aa_spi)
-    logging.info("Calculating ECMWF SMA")
-    sma_ecmwf = load_index(dri.SMA_ECMWF,cdi.config,cdi.aa_sma)
-    logging.info("Calculating GDO SMA")
-    sma_gdo = load_index(dri.SMA_GDO,cdi.config,cdi.aa_sma)
-    logging.info("Calculating FAPAR")
-    fapar = load_index(dri.FPAR_GDO,cdi.config,cdi.aa_fpr)
-
-    # Load precip anomaly data from SAFE software
-    if aa.latitude == 50.06:
-        safe = local.LoadSAFE(logger=logging, infile = False)
-        spi_ecmwf = safe.load_safe(spi_ecmwf, lat_val=aa.latitude, lon_val=aa.longitude)
-        aa.end_date = '20241231'
-
-    return spi_ecmwf, spi_gdo, sma_ecmwf, sma_gdo, fapar
-
-@st.cache(hash_funcs={pd.DataFrame: id}, allow_output_mutation=True)
+@st.cache_data(max_entries=8)
+def load_safe_spi(df_spi: pd.DataFrame, lat: float, lon: float, outdir: str):
+    """
+    SPI extended with the SAFE climate scenario, so the GeoJSON is only parsed once per location
+    """
+    safe = local.LoadSAFE(logger=logging, infile = False, cache_dir=outdir)
+    return safe.load_safe(df_spi, lat_val=lat, lon_val=lon)
+
+# Keyed on the values that define the CDI rather than on the argument objects, which are rebuilt each rerun
+@st.cache_resource(hash_funcs={config.AnalysisArgs: lambda a: (a.latitude,a.longitude,a.start_date,a.end_date,a.singleval),
+                               config.Config: lambda c: (c.outdir,c.baseline_start,c.baseline_end)})
 def load_cdi(aa: config.AnalysisArgs,cf: config.Config,source,sma_var):
     aa_cdi = config.CDIArgs(
         latitude=aa.latitude,
@@ -136,21 +239,19 @@ def load_cdi(aa: config.AnalysisArgs,cf: config.Config,source,sma_var):
         singleval=aa.singleval
     )
     logging.info("Calculating CDI")
-    cdi = load_index(dri.CDI,cf,aa_cdi)
+    # fAPAR is the same whatever the source, so both CDIs share one cached object
+    fpr = load_index(dri.FPAR_GDO,cf,dri.CDI.fpr_args(aa_cdi))
+    cdi = prepare_index(dri.CDI(cf,aa_cdi,fpr=fpr),cf)
 
     return cdi
 
-# @st.cache(hash_funcs={pd.DataFrame: id}, allow_output_mutation=True)
-# def load_era_soilmoisture(fname):
-#     return  xr.open_dataset(fname).isel(expver=0).mean(('latitude','longitude')).drop_vars('expver').to_dataframe()
-
-@st.cache(hash_funcs={pd.DataFrame: id}, allow_output_mutation=True)
-def draw_map(aa):
+@st.cache_resource
+def draw_map(lat: float, lon: float):
     boxsz = 0.1
-    latmax = np.nanmax(aa.latitude) + boxsz
-    lonmin = np.nanmin(aa.longitude) - boxsz
-    latmin = np.nanmin(aa.latitude) - boxsz
-    lonmax = np.nanmax(aa.longitude) + boxsz
+    latmax = lat + boxsz
+    lonmin = lon - boxsz
+    latmin = lat - boxsz
+    lonmax = lon + boxsz
 
     fig = go.Figure(go.Scattermapbox(
         fill = "toself",
@@ -163,7 +264,7 @@ def draw_map(aa):
         margin=dict(l=0, r=20, t=20, b=20),
         mapbox = {
             'style': "stamen-terrain",
-            'center': {'lon': aa.longitude, 'lat': aa.latitude },
+            'center': {'lon': lon, 'lat': lat },
             'zoom': 7},
         showlegend = False)
     return fig
@@ -201,12 +302,11 @@ with st.sidebar:
         else:
             aa = DOWNLOADED['SE England, 2020-2022']
 
-    # Pre-download CDI options for speed and process CDI calc
-    cdi_gdo = load_cdi(aa,cf,'GDO','smant')
+    # Plots can extend past the analysis period, kept apart from aa so the cached loaders keyed on it are unaffected
+    plot_end_date = aa.end_date
 
-    # Only do ECMWF if data selection is restricted
+    # CDI objects are only loaded in the branches that use them, ECMWF only if data selection is restricted
     if RESTRICT_DATA_SELECTION:
-        cdi_ecmwf = load_cdi(aa,cf,'ECMWF',SMA_LEVEL_DEFAULT)
         view = st.radio('View mode', ['CDI Breakdown','Index Comparison'])
     else:
         view = 'CDI Breakdown'
@@ -217,19 +317,21 @@ with st.sidebar:
             # ERA5 data has multiple layers, so option to choose which layer is used
             sma_var = st.selectbox('Soil Water Indicator Level',['zscore_swvl' + str(i) for i in ['1','2','3','4']])
 
-            # Need to re-initialise the object using the selected layer
-            cdi_obj = cdi_ecmwf if sma_var == SMA_LEVEL_DEFAULT else load_cdi(aa,cf,'ECMWF',sma_var)
+            # Each layer is a separate cached object
+            cdi_obj = load_cdi(aa,cf,'ECMWF',sma_var)
 
         elif sma_source=='GDO':
-            # Re-use the object initialised earlier
-            cdi_obj = cdi_gdo
+            cdi_obj = load_cdi(aa,cf,'GDO','smant')
         cdi = cdi_obj.data_df
+        # CDI shading is computed once per rerun and shared by all the breakdown plots
+        cdi_runs = get_cdi_runs(cdi)
         #st.info("CDI: {}".format(cdi))
-        plot_cdi=True
 
     elif view == 'Index Comparison':
 
         #spi, sma_ecmwf, sma_edo, fpr = load_indices(cdi)
+        cdi_gdo = load_cdi(aa,cf,'GDO','smant')
+        cdi_ecmwf = load_cdi(aa,cf,'ECMWF',SMA_LEVEL_DEFAULT)
 
         df_spi_ecmwf = cdi_ecmwf.spi.data_df
         df_spi_gdo = cdi_gdo.spi.data_df
@@ -237,41 +339,42 @@ with st.sidebar:
         df_sma_edo = cdi_gdo.sma.data_df
         df_fpr = cdi_gdo.fpr.data_df
 
-        # Load precip anomaly data from SAFE software
+        # Load precip anomaly data from SAFE software, extending the plots to the end of the scenario
         if aa.latitude == 50.06:
-            safe = local.LoadSAFE(logger=logging, infile = False)
-            df_spi_ecmwf = safe.load_safe(df_spi_ecmwf, lat_val=aa.latitude, lon_val=aa.longitude)
-            aa.end_date = '20241231'
+            df_spi_ecmwf = load_safe_spi(df_spi_ecmwf, aa.latitude, aa.longitude, cf.outdir)
+            plot_end_date = SAFE_END_DATE
 
         #ds_swvl = load_era_soilmoisture(sma_ecmwf.download_obj_baseline.download_file_path)
 
         st.header('Compare Indices:')
-        for itm in plot_options:
-            plot_options[itm] = st.checkbox(itm,key=itm)
-        #st.info(plot_options)
+        # A single widget for all the options rather than one checkbox each
+        selected = st.multiselect('Indices',list(plot_options.keys()),default=[])
+        plot_options = {itm: itm in selected for itm in plot_options}
         sma_level = st.selectbox('Soil Water Indicator Level',['1','2','3','4'])
-        plot_cdi=False
 
 
 
 col1,col2 = st.columns(2)
 with col1:
-    st.plotly_chart(draw_map(aa))
+    st.plotly_chart(draw_map(float(aa.latitude),float(aa.longitude)))
 
 figs = []
 
+# Plot limits, read once the sidebar has settled the analysis period
+xlim = (pd.to_datetime(aa.start_date, format='%Y%m%d'), pd.to_datetime(plot_end_date, format='%Y%m%d'))
+
 if view == "Index Comparison":
 
     if plot_options['Precip (ECMWF)']:
-        fig = plot(df_spi_ecmwf,['tp'],'Precipitation (ECMWF)',warning=-1,warning_var='tp')
+        fig = plot(df_spi_ecmwf,['tp'],'Precipitation (ECMWF)',warning=-1,warning_var='tp',xlim=xlim)
         figs.append(fig)
 
     if plot_options['SPI (ECMWF)']:
-        fig = plot(df_spi_ecmwf,['spi'],'Standardised Precipitation Index (ECMWF)',warning=-1,warning_var='spi')
+        fig = plot(df_spi_ecmwf,['spi'],'Standardised Precipitation Index (ECMWF)',warning=-1,warning_var='spi',xlim=xlim)
         figs.append(fig)
 
     if plot_options['SPI (GDO)']:
-        fig = plot(df_spi_gdo,['spg03'],'Standardised Precipitation Index (GDO)',warning=-1,warning_var='spg03')
+        fig = plot(df_spi_gdo,['spg03'],'Standardised Precipitation Index (GDO)',warning=-1,warning_var='spg03',xlim=xlim)
         figs.append(fig)
 
     # if plot_options['Soil Water Vol. (ECMWF)']:
@@ -279,61 +382,65 @@ if view == "Index Comparison":
     #     figs.append(fig)
 
     if plot_options['SMA (ECMWF)']:
-        fig = plot(df_sma_ecmwf,['zscore_swvl'+ str(n) for n in[1,2,3,4]],title='Soil Moisture Anomaly (ECMWF)',warning=-1,warning_var='zscore_swvl{}'.format(sma_level))
+        fig = plot(df_sma_ecmwf,['zscore_swvl'+ str(n) for n in[1,2,3,4]],title='Soil Moisture Anomaly (ECMWF)',warning=-1,warning_var='zscore_swvl{}'.format(sma_level),xlim=xlim)
         figs.append(fig)
 
     if plot_options['SMA (GDO)']:
-        fig = plot(df_sma_edo,['smant'],title='Ensemble Soil Moisture Anomaly (GDO)',warning=-1,warning_var='smant')
+        fig = plot(df_sma_edo,['smant'],title='Ensemble Soil Moisture Anomaly (GDO)',warning=-1,warning_var='smant',xlim=xlim)
         figs.append(fig)
 
     if plot_options['fAPAR (GDO)']:
-        fig = plot(df_fpr,['fpanv'],title='Fraction of Absorbed Photosynthetically Active Radiation',warning=-1,warning_var='fpanv')
+        fig = plot(df_fpr,['fpanv'],title='Fraction of Absorbed Photosynthetically Active Radiation',warning=-1,warning_var='fpanv',xlim=xlim)
         figs.append(fig)
 
 elif view == "CDI Breakdown":
 
-    fig = plot(cdi,[cdi_obj.args.spi_var],title='SPI')
+    fig = plot(cdi,[cdi_obj.args.spi_var],title='SPI',xlim=xlim,cdi_runs=cdi_runs)
     figs.append(fig)
 
-    fig = plot(cdi,[cdi_obj.args.sma_var],title='SMA')
+    fig = plot(cdi,[cdi_obj.args.sma_var],title='SMA',xlim=xlim,cdi_runs=cdi_runs)
     figs.append(fig)
 
-    fig = plot(cdi,['fpanv'],title='fAPAR')
+    fig = plot(cdi,['fpanv'],title='fAPAR',xlim=xlim,cdi_runs=cdi_runs)
     figs.append(fig)
 
+def figure_rgb(fig: Figure, dpi=600):
+    """
+    Renders a figure to an RGB array through Agg's raw output, without a PNG encode and decode
+    """
+    buf = io.BytesIO()
+    fig.savefig(buf, format='raw', dpi=dpi)
+    width, height = (fig.get_size_inches() * dpi).astype(int)
+    return np.frombuffer(buf.getvalue(), dtype=np.uint8).reshape(height, width, 4)[..., :3]
+
+def process_image(figs):
+    """
+    Stacks the figures vertically and encodes the result as a single PNG
+    """
+    # All figures share a width, so stack them in one copy rather than growing the image per figure
+    v_img = np.vstack([figure_rgb(fig) for fig in figs])
+
+    # Write the pixels straight to PNG, light compression keeps the large image quick to encode
+    buf = io.BytesIO()
+    Image.fromarray(v_img).save(buf, format='PNG', compress_level=1)
+    return buf.getvalue()
+
 # Display plots and make available to download
-buf = io.BytesIO()
 fn = 'output.png'
 with col2:
-    for i,fig in enumerate(figs):
+    for fig in figs:
         st.pyplot(fig)
-        fig.savefig(buf, format='png', dpi=600)
-        buf.seek(0)
-        img_arr = np.frombuffer(buf.getvalue(), dtype=np.uint8)
-        img = cv2.imdecode(img_arr, 1)
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        if i == 0:
-            v_img = img.copy()
-        else:
-            v_img = cv2.vconcat([v_img, img])
-
-    #cv2.imwrite(fn, v_img)
-
-    def process_image(v_img):
-        buf = io.BytesIO()
-        fig, ax = plt.subplots()
-        ax.imshow(v_img)
-        plt.axis('off')
-        ax.axes.get_xaxis().set_visible(False)
-        ax.axes.get_yaxis().set_visible(False)
-        fig.savefig(buf, format='png', dpi=600, bbox_inches='tight', pad_inches = 0)
-        return buf
 
     if len(figs) > 0:
-
-        btn = st.download_button(
-            label="Download image",
-            data=process_image(v_img),
-            file_name=fn,
-            mime="image/png"
-        )
+        # The 600 dpi composite takes seconds, so only build it when asked and keep it while the figures are unchanged
+        figs_key = tuple(fig.get_label() for fig in figs)
+        if st.button("Prepare download"):
+            st.session_state['img_buf'] = (figs_key, process_image(figs))
+
+        if st.session_state.get('img_buf', (None,))[0] == figs_key:
+            btn = st.download_button(
+                label="Download image",
+                data=st.session_state['img_buf'][1],
+                file_name=fn,
+                mime="image/png"
+            )
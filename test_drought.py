@@ -1,27 +1,27 @@
 import os
+import functools
 from sys import exit
-import numpy as np
-import geopandas as gpd
-import matplotlib.pyplot as plt
 import argparse
 
 
 # Links from Climate-drought repository
-from climate_drought import drought_indices as dri, config
+# drought_indices pulls in the full processing stack, so it is only imported once an index is needed
+from climate_drought import config
 
 import logging
 logging.basicConfig(level=logging.INFO)
 
+# Product name to index class name in drought_indices
 INDEX_MAP = {
-    'SPI_ECMWF': dri.SPI_ECMWF,
-    'SPI_GDO': dri.SPI_GDO,
-    'SPI_NCG': dri.SPI_NCG,
-    'SMA_ECMWF': dri.SMA_ECMWF,
-    'SMA_GDO': dri.SMA_GDO,
-    'fAPAR': dri.FPAR_GDO,
-    'CDI': dri.CDI,
-    'FEATURE_SAFE': dri.FEATURE_SAFE,
-    'UTCI': dri.UTCI
+    'SPI_ECMWF': 'SPI_ECMWF',
+    'SPI_GDO': 'SPI_GDO',
+    'SPI_NCG': 'SPI_NCG',
+    'SMA_ECMWF': 'SMA_ECMWF',
+    'SMA_GDO': 'SMA_GDO',
+    'fAPAR': 'FPAR_GDO',
+    'CDI': 'CDI',
+    'FEATURE_SAFE': 'FEATURE_SAFE',
+    'UTCI': 'UTCI'
 }
 
 class DROUGHT:
@@ -44,6 +44,15 @@ class DROUGHT:
         self.product = args.product
         if args.utci:
             self.product = "UTCI"
+
+        # Setup default input sources
+        if self.product == "SPI":
+            self.product = "SPI_ECMWF"
+        elif self.product == "SMA":
+            self.product = "SMA_ECMWF"
+        elif self.product == "SAFE":
+            self.product = "FEATURE_SAFE"
+
         self.config = config.Config(args.outdir,args.indir,args.verbose,aws=args.aws,era_daily=args.era_daily)
 
         if args.product == 'CDI':
@@ -59,54 +68,68 @@ class DROUGHT:
 
         self.logger.info("\n")
 
-    @property
-    def index(self) -> dri.DroughtIndex:
-        return INDEX_MAP[self.product](self.config, self.args)
+    @functools.cached_property
+    def index(self) -> 'dri.DroughtIndex':
+        from climate_drought import drought_indices as dri
+        return getattr(dri, INDEX_MAP[self.product])(self.config, self.args)
 
 
     def run_index(self):
 
-        # Setup default input sources
-        if self.product == "SPI":
-            self.product = "SPI_ECMWF"
-        elif self.product == "SMA":
-            self.product = "SMA_ECMWF"
-        elif self.product == "SAFE":
-            self.product = "FEATURE_SAFE"
-
-        self.logger.debug("Computing {idx} index for {sd} to {ed}.".format(idx=self.product, sd=self.config.baseline_start, ed=self.config.baseline_end))
+        self.logger.debug("Computing %s index for %s to %s.", self.product, self.config.baseline_start, self.config.baseline_end)
 
         exit_code = 0
 
         idx = self.index
+        output_file_path = idx.output_file_path
 
-        if os.path.exists(idx.output_file_path):
-            self.logger.info("Processed file '{}' already exists.".format(idx.output_file_path))
+        # Only re-check for the output when it had to be generated
+        exists = os.path.exists(output_file_path)
+        if exists:
+            self.logger.info("Processed file '{}' already exists.".format(output_file_path))
         else:
             idx.download()
             idx.process()
-            self.logger.info("Downloading and processing complete for '{}' completed with format {}.".format(idx.output_file_path, self.args.oformat))
+            self.logger.info("Downloading and processing complete for '{}' completed with format {}.".format(output_file_path, self.args.oformat))
+            exists = os.path.exists(output_file_path)
 
-        if os.path.exists(idx.output_file_path):
+        if exists:
             exit_code = 1
-            self.logger.info("{} processing complete, generated {}".format(self.product, idx.output_file_path))
+            self.logger.info("{} processing complete, generated {}".format(self.product, output_file_path))
 
         else:
-            self.logger.info("Processing failed, {} does not exist".format(idx.output_file_path))
+            self.logger.info("Processing failed, {} does not exist".format(output_file_path))
 
         # normalise data
         def norm(data):
             return (data)/(max(data)-min(data))
 
         # Load in data and display then plot
-        df = gpd.read_file(idx.output_file_path)
+        import pandas as pd
+        import matplotlib.pyplot as plt
+        file_ext = os.path.splitext(output_file_path)[1]
+        if file_ext == '.json':
+            # Only the feature properties are plotted, so the GeoJSON is read without building geometries
+            import orjson
+            with open(output_file_path, 'rb') as f:
+                data = orjson.loads(f.read())
+            df = pd.DataFrame.from_records([feature['properties'] for feature in data['features']])
+            df['_date'] = pd.to_datetime(df['_date'], format='%Y-%m-%d')
+        elif file_ext in ['.zarr', '.nc']:
+            import xarray as xr
+            ds = xr.open_zarr(output_file_path) if file_ext == '.zarr' else xr.open_dataset(output_file_path)
+            df = ds.to_dataframe().reset_index().rename(columns={'time': '_date'})
+        else:
+            self.logger.info("Plotting is not supported for {}".format(output_file_path))
+            return exit_code
         print(df)
         fig, ax1 = plt.subplots()
         ax1.plot(df._date,df.spi,color='b',label='spi')
         #ax1.set_ylim([-1,1])
         ax1.set_ylabel('SPI [blue]')
-        tick_list = df._date.values[::3]
-        plt.xticks(rotation=45, ticks=tick_list)
+        # Dates are already parsed, so every third one is used directly as a tick
+        ax1.set_xticks(df._date.values[::3])
+        ax1.tick_params(axis='x', labelrotation=45)
         if self.product == 'UTCI':
             ax1.plot(df._date,df.hindex,color='g',label='utci')
             ax1.set_ylabel('SPI [blue], Health index [green]')